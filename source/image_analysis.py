@@ -1,20 +1,65 @@
+import argparse
+import hashlib
 import math
 import matplotlib.pyplot as plt
 import numpy as np
 import random
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, TensorDataset
 from torchvision import transforms, models
 from torchvision.datasets import ImageFolder
 import os
 
 
-def load_dataset(transform, limit=600, shuffle=True):
+def get_cache_key(transform, image_folder):
+    """
+    Identify the preprocessing of a cached dataset by its transform, its number of images and a hash of their paths
+    """
+    paths = "\n".join(sorted(path for path, _ in image_folder.samples))
+    paths_hash = hashlib.sha1(paths.encode()).hexdigest()
+    return "{!r} | {} images | {}".format(transform, len(image_folder.samples), paths_hash)
+
+
+def cache_dataset(transform, cache_path):
+    """
+    Decode and preprocess all the images of the Stanford Dogs dataset once and save them to cache_path
+    as a single uint8 tensor of shape (N, 3, H, W), along with their labels and the cache key
+    """
+    dataset = ImageFolder('images_dataset', transform=transform)
+    first_image, _ = dataset[0]
+    images = torch.empty((len(dataset), *first_image.shape), dtype=torch.uint8)
+    labels = torch.tensor(dataset.targets, dtype=torch.int64)
+
+    loader = DataLoader(dataset, batch_size=64, num_workers=(os.cpu_count() or 1) // 2)
+    start = 0
+    for ds_images, _ in loader:
+        images[start:start + len(ds_images)] = ds_images
+        start += len(ds_images)
+
+    cache_key = get_cache_key(transform, dataset)
+    torch.save({'images': images, 'labels': labels, 'key': cache_key}, cache_path)
+
+
+def load_dataset(transform, limit=600, shuffle=True, cache_path=None):
     """
     Load Stanford Dogs dataset and preprocess the images with a specified limit
     http://vision.stanford.edu/aditya86/ImageNetDogs/
+    If a cache_path is given, all the preprocessed images of the dataset are cached there on the first run and
+    memory-mapped on the next runs, the cache is rebuilt when the transform or the images change
     """
-    dataset = ImageFolder('images_dataset', transform=transform)
+    if cache_path is None:
+        dataset = ImageFolder('images_dataset', transform=transform)
+    else:
+        cache_key = get_cache_key(transform, ImageFolder('images_dataset'))
+
+        cache = torch.load(cache_path, mmap=True) if os.path.exists(cache_path) else None
+        if cache is None or cache.get('key') != cache_key:
+            cache = None  # Release the memory map of the stale cache before overwriting its file
+            cache_dataset(transform, cache_path)
+            cache = torch.load(cache_path, mmap=True)
+
+        dataset = TensorDataset(cache['images'], cache['labels'])
+
     if shuffle:
         sample_list_index = random.sample(range(len(dataset)), limit)
         dataset = torch.utils.data.Subset(dataset, sample_list_index)
@@ -24,11 +69,17 @@ def load_dataset(transform, limit=600, shuffle=True):
     return dataset
 
 
-def load_pre_trained_model(select_device):
+# Models whose children without the last one (the classifier) end with global pooling, giving one feature vector
+SUPPORTED_ARCHITECTURES = ['resnet18', 'resnet34', 'resnet50', 'mobilenet_v3_small']
+
+
+def load_pre_trained_model(select_device, input_shape=None, architecture='resnet50'):
     """
-    Load the pre-trained model
+    Load the pre-trained model, one of SUPPORTED_ARCHITECTURES, e.g. 'resnet50' or a lighter one like 'resnet18'.
+    On a GPU the model runs in half precision and, if the shape of the input batches is given,
+    it is compiled with CUDA graphs for that shape.
     """
-    model_set = models.resnet50(weights='IMAGENET1K_V1')
+    model_set = models.get_model(architecture, weights='IMAGENET1K_V1')
 
     # Set the model to evaluation mode to avoid updating the running statistics of batch normalization layers
     model_set.eval()
@@ -39,33 +90,106 @@ def load_pre_trained_model(select_device):
     # set processing device
     model_set.to(select_device)
 
+    # Half precision is enough for the Euclidean distances of the features and doubles the GPU throughput
+    if select_device == 'cuda':
+        model_set.half()
+
+    if select_device == 'cuda' and input_shape is not None:
+        # Fuse the layers and replay the whole forward pass as a CUDA graph to avoid the per-layer launch overhead
+        model_set = torch.compile(model_set, mode="reduce-overhead", fullgraph=True, backend="inductor")
+
+        # Warm up with a batch of the target shape to trigger the compilation and the CUDA graph capture
+        warm_up_batch = torch.zeros(input_shape, dtype=torch.float16, device=select_device)
+        with torch.no_grad():
+            for _ in range(3):
+                model_set(warm_up_batch)
+
     return model_set
 
 
-def calculate_features(dataset_images):
+class DataPrefetcher:
     """
-    Calculate the features of the images using the pre-trained model
+    Iterate over a data loader and copy the next batch to the GPU on a separate CUDA stream,
+    so that the copy overlaps with the processing of the current batch
     """
-    features_list = []
-    for ds_image, _ in dataset_images:
-        # Add batch dimension to image tensor
-        ds_image = ds_image.unsqueeze(0)
 
-        # Move the image tensor to the same device as the pre-trained model
-        ds_image = ds_image.to(device)
+    def __init__(self, loader):
+        self.loader = iter(loader)
+        self.stream = torch.cuda.Stream()
+        self.preload()
 
-        # Pass the image through the ResNet50 model
-        with torch.no_grad():
-            feature = pre_trained_model(ds_image).squeeze().cpu().numpy()  # Convert feature to numpy array
+    def preload(self):
+        try:
+            self.next_images, self.next_labels = next(self.loader)
+        except StopIteration:
+            self.next_images = None
+            self.next_labels = None
+            return
+
+        with torch.cuda.stream(self.stream):
+            # Copy the uint8 image tensors to the GPU and scale them to [0, 1], in half precision like the model
+            self.next_images = self.next_images.to(device, non_blocking=True).half().div_(255)
 
-        # Append the feature vector to the list of features
-        features_list.append(feature)
+    def __iter__(self):
+        return self
 
-    # Make them 1D
-    for i in range(len(features_list)):
-        features_list[i] = features_list[i].reshape(features_list[i].size)
+    def __next__(self):
+        # Wait for the copy of the batch to finish before using it
+        torch.cuda.current_stream().wait_stream(self.stream)
+        images, labels = self.next_images, self.next_labels
+        if images is None:
+            raise StopIteration
 
-    return features_list
+        # The images were allocated on the prefetch stream but are used on the current stream,
+        # the labels stay in host memory
+        images.record_stream(torch.cuda.current_stream())
+
+        self.preload()
+        return images, labels
+
+
+def calculate_features(dataset_images, batch_size=64, pad_batches=False):
+    """
+    Calculate the features of the images using the pre-trained model.
+    The images are passed through the model in batches of batch_size. With pad_batches the last batch is padded
+    to batch_size, so that a compiled model only ever sees one input shape.
+    The features are stored in half precision (float16) and kept on the processing device.
+    The labels of the images are collected in the same pass and returned as a numpy array.
+    """
+    # Indexing the memory-mapped cache is only a slice, worker processes would only add their startup and IPC cost.
+    # The images of an ImageFolder are decoded in parallel by the workers.
+    if isinstance(dataset_images.dataset, TensorDataset):
+        num_workers = 0
+    else:
+        num_workers = (os.cpu_count() or 1) // 2
+    loader = DataLoader(dataset_images, batch_size=batch_size, num_workers=num_workers,
+                        pin_memory=(device == 'cuda'))
+
+    if device == 'cuda':
+        # Copy the next batch to the GPU while the current one passes through the model
+        batches = DataPrefetcher(loader)
+    else:
+        # Scale the uint8 image tensors to [0, 1]
+        batches = ((ds_images.float().div_(255), labels) for ds_images, labels in loader)
+
+    features_list = []
+    labels_list = []
+    for ds_images, ds_labels in batches:
+        number_of_images = len(ds_images)
+        if pad_batches and number_of_images < batch_size:
+            padding = ds_images.new_zeros((batch_size - number_of_images, *ds_images.shape[1:]))
+            ds_images = torch.cat([ds_images, padding])
+
+        # Pass the whole batch through the pre-trained model, one flattened feature vector per image.
+        # Always copy the output, the output of a CUDA graph is overwritten by its next replay
+        with torch.no_grad():
+            features_batch = pre_trained_model(ds_images)[:number_of_images].flatten(1).to(torch.float16, copy=True)
+
+        # Append the feature vectors of the batch to the list of features
+        features_list.append(features_batch)
+        labels_list.append(ds_labels)
+
+    return torch.cat(features_list), torch.cat(labels_list).numpy()
 
 
 def calculate_similarity(features_of_all_images):
@@ -73,81 +197,78 @@ def calculate_similarity(features_of_all_images):
     Calculate the similarity scores between images based on the inverse Euclidean distance of their features.
     Similarity score = 1 / (Euclidean distance)
     """
-    features_of_all_images = np.array(features_of_all_images)
-    similarity_scores_list = []
+    # Pairwise squared distances from |a - b|^2 = |a|^2 + |b|^2 - 2 * a.b, the squared norms in single precision
+    squared_norms = features_of_all_images.float().pow(2).sum(dim=1)
+    if features_of_all_images.is_cuda:
+        # Half precision matrix multiplication, cuBLAS accumulates in single precision and moves half the bytes
+        gram_matrix = (features_of_all_images @ features_of_all_images.T).float()
+    else:
+        # CPUs have no fast half precision matrix multiplication
+        features_fp32 = features_of_all_images.float()
+        gram_matrix = features_fp32 @ features_fp32.T
+    squared_distances = squared_norms[:, None] + squared_norms[None, :] - 2 * gram_matrix
+    distances = squared_distances.clamp_(min=0).sqrt_()  # Clip negative values caused by rounding errors
 
-    for i in range(len(features_of_all_images)):
-        distances = np.linalg.norm(features_of_all_images - features_of_all_images[i], axis=1)
-        scores = 1 / np.where(distances == 0, 0.00001, distances)  # Avoid division by zero
-        similarity_scores_list.append(list(enumerate(scores)))
+    # The distance of an image to itself, or to an exact duplicate, is exactly zero, which the expansion above
+    # does not guarantee because of rounding errors
+    _, feature_ids = torch.unique(features_of_all_images, dim=0, return_inverse=True)
+    distances.masked_fill_(feature_ids[:, None] == feature_ids[None, :], 0)
+    similarity_scores = 1 / distances.masked_fill(distances == 0, 0.00001)  # Avoid division by zero
 
-    return similarity_scores_list
+    return similarity_scores
 
 
 def rank_normalization(similarity_lists):
     """
     ---Rank Normalization---
 
-    Use similarity scores to sort
+    Use similarity scores to compute the normalized ranks, the lower the rank the more similar the images
     """
-    normalized_similarity_scores = []
-    L = len(similarity_lists[0])  # Length of each similarity list
+    L = similarity_lists.shape[1]  # Length of each similarity list
 
-    for i in range(len(similarity_lists)):
-        ranks = []
-        for j in range(len(similarity_lists[i])):
-            rank = 2 * L - (similarity_lists[i][j][1] + similarity_lists[j][i][1])
-            ranks.append((j, rank))
-        # sort the ranks based on the rank (the second value of the tuple) and append to the
-        # normalized_similarity_scores list
-        normalized_similarity_scores.append(sorted(ranks, key=lambda x: x[1]))
+    # Rank in double precision, in single precision the spacing around 2 * L is about 1e-4 and
+    # small affinities would collapse into ties
+    similarity_lists = similarity_lists.double()
 
-    return normalized_similarity_scores
+    normalized_ranks = 2 * L - (similarity_lists + similarity_lists.T)
 
+    return normalized_ranks
 
-def get_the_features_of_the_image(image, model):
+
+def get_hypergraph_construction(normalized_ranks, k=5):
     """
-    ---Feature Extraction---
+    ---Hypergraph Construction---
 
-    Get the features of the image
+    Create hyperedges from the k top ranked images of each image.
+    Returns an (N, k) tensor, each row sorted by rank.
     """
-    image_tensor = transform_pipeline(image)
-    features_var = model(image_tensor.unsqueeze(0).to(device))  # extract features
-    features = features_var.data.cpu()  # get the tensor out of the variable and copy it to host memory
+    # Select the k lowest ranks of each row, sorted by rank, without sorting the whole row
+    hyperedges = torch.topk(normalized_ranks, k, dim=1, largest=False, sorted=True).indices
 
-    return features
+    return hyperedges
 
 
-def get_hypergraph_construction(similarity_scores, k=5):
+def get_position_weights(k=5):
     """
-    ---Hypergraph Construction---
-
-    Create hyperedges as lists
+    Calculate the weight of each position in a hyperedge of size k, 1 - log_{k+1}(position).
+    The weights do not change between iterations, so they are calculated once.
     """
-    hyperedges = []
-    for i in range(len(similarity_scores)):
-        hyperedge = []
-        for j in range(k):
-            hyperedge.append(similarity_scores[i][j][0])
-        # Add the hyperedge to the hyperedges
-        hyperedges.append(hyperedge)
-    return hyperedges
+    positions = torch.arange(1, k + 1, dtype=torch.float32, device=device)
+    position_weights = 1 - torch.log(positions) / math.log(k + 1)
+    return position_weights
 
 
-def create_edge_associations(hyperedges, k=5):
+def create_edge_associations(hyperedges, position_weights):
     """
     ---Create Edge Associations---
 
     Create edge associations based on the hyperedges
     """
-    associations = np.zeros((len(hyperedges), len(hyperedges)))
-    for i, e in enumerate(hyperedges):
-        for j in range(len(hyperedges)):
-            if j in e:
-                position = e.index(j) + 1  # Get the position of the node in the hyperedge
-                associations[i][j] = 1 - math.log(position, k + 1)  # Calculate the weight
-            else:
-                associations[i][j] = 0
+    number_of_images, k = hyperedges.shape
+
+    # The weight of a node depends only on its position in the hyperedge
+    associations = torch.zeros((number_of_images, number_of_images), device=hyperedges.device)
+    associations.scatter_(1, hyperedges, position_weights.expand(number_of_images, k))
     return associations
 
 
@@ -157,12 +278,7 @@ def create_edge_weights(hyperedges, edge_associations):
 
     Calculate the weights of the hyperedges
     """
-    weights = []
-    for i, e in enumerate(hyperedges):
-        sum = 0
-        for h in e:
-            sum += edge_associations[i][h]
-        weights.append(sum)
+    weights = torch.gather(edge_associations, 1, hyperedges).sum(dim=1)
     return weights
 
 
@@ -174,7 +290,7 @@ def get_hyperedges_similarities(incidence_matrix):
     """
     Similarity_matrix_h = incidence_matrix @ incidence_matrix.T  # Matrix multiplication
     Similarity_matrix_u = incidence_matrix.T @ incidence_matrix  # Matrix multiplication
-    Similarity_matrix = np.multiply(Similarity_matrix_h, Similarity_matrix_u)  # Hadamard product
+    Similarity_matrix = torch.mul(Similarity_matrix_h, Similarity_matrix_u)  # Hadamard product
     return Similarity_matrix
 
 
@@ -186,14 +302,17 @@ def get_cartesian_product_of_hyperedge_elements(edge_weights, edge_associations,
     Then calculate the membership degrees of the hyperedges based on weights.
     Finally, calculate the matrix C.
     """
-    membership_degrees = [{} for _ in range(len(hyperedges))]
-    matrix_c = np.zeros((len(hyperedges), len(hyperedges)))
-    for i, e in enumerate(hyperedges):
-        eq_ei = np.transpose(np.meshgrid(e, e)).reshape(-1, 2)
-        for (vertices1, vertices2) in eq_ei:
-            membership_degrees[i][(vertices1, vertices2)] = edge_weights[i] * edge_associations[i][vertices1] * \
-                                                            edge_associations[i][vertices2]
-            matrix_c[vertices1][vertices2] += membership_degrees[i][(vertices1, vertices2)]
+    matrix_c = torch.zeros_like(edge_associations)
+
+    # Membership degrees of every (vertex1, vertex2) pair of each hyperedge, shape (N, k, k)
+    associations = torch.gather(edge_associations, 1, hyperedges)
+    membership_degrees = edge_weights[:, None, None] * associations[:, :, None] * associations[:, None, :]
+
+    # Accumulate the membership degrees of all the hyperedges, pairs shared by several hyperedges are summed
+    k = hyperedges.shape[1]
+    vertices1 = hyperedges[:, :, None].expand(-1, -1, k)
+    vertices2 = hyperedges[:, None, :].expand(-1, k, -1)
+    matrix_c.index_put_((vertices1, vertices2), membership_degrees, accumulate=True)
     return matrix_c
 
 
@@ -203,7 +322,7 @@ def get_hypergrapgh_based_simalarity(matrix_c, hyperedges_similarities):
 
     Computes final affinity matrix.
     """
-    affinity_matrix = np.multiply(matrix_c, hyperedges_similarities)
+    affinity_matrix = torch.mul(matrix_c, hyperedges_similarities)
     return affinity_matrix
 
 
@@ -221,40 +340,55 @@ def show_image(image_index, save_image=False, image_name=""):
     plt.show()
 
 
-def calculate_accuracy(retrieved_images, query_image_label):
+def calculate_accuracy(retrieved_images, query_image_label, labels):
     """
-    Calculate the accuracy of the retrieved images
+    Calculate the accuracy of the retrieved images, using the labels of all the images
     """
-    count = 0
-    for i in range(len(retrieved_images)):
-        image_index, score = retrieved_images[i]
-        image, label = data_loader[image_index]
+    retrieved_indices = np.array([image_index for image_index, _ in retrieved_images])
+    retrieved_labels = labels[retrieved_indices]
+    for (image_index, score), label in zip(retrieved_images, retrieved_labels):
         print("Image index: {:<5} | Image label: {:<5} | Score: {:.6f}".format(image_index, label, score))
-        if label == query_image_label:
-            count += 1
 
-    return (count / len(retrieved_images)) * 100
+    return (retrieved_labels == query_image_label).mean() * 100
 
 
 if __name__ == "__main__":
     print("Image Analysis: Final Exam")
 
+    parser = argparse.ArgumentParser(description="Content-based image retrieval with the LHRR algorithm")
+    parser.add_argument('--limit', type=int, default=600, help="number of images sampled from the dataset")
+    parser.add_argument('--architecture', default='resnet50', choices=SUPPORTED_ARCHITECTURES,
+                        help="torchvision pre-trained model used for the features")
+    parser.add_argument('--compile', action='store_true',
+                        help="compile the pre-trained model with CUDA graphs, only pays off for many batches on a GPU")
+    parser.add_argument('--cache', action='store_true',
+                        help="cache all the preprocessed images of the dataset in images_dataset.pt (about 740 MB)")
+    args = parser.parse_args()
+
+    # Resize and crop to a fixed size so that the images can be batched
     transform_pipeline = transforms.Compose([
-        transforms.ToTensor()
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.PILToTensor()
     ])
 
     # Set the processing device
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+    batch_size = 64  # The number of images passed through the pre-trained model at once
+    compile_model = args.compile and device == 'cuda'
+
     print("Device: ", device)
 
     # Load the Stanford Dogs dataset
-    data_loader = load_dataset(transform_pipeline)
+    cache_path = 'images_dataset.pt' if args.cache else None
+    data_loader = load_dataset(transform_pipeline, limit=args.limit, cache_path=cache_path)
 
     print("Dataset size: ", len(data_loader))
 
     # Load the pre-trained model
-    pre_trained_model = load_pre_trained_model(device)
+    input_shape = (batch_size, 3, 224, 224) if compile_model else None
+    pre_trained_model = load_pre_trained_model(device, input_shape=input_shape, architecture=args.architecture)
 
     # print("Pre-trained model: ", pre_trained_model)
 
@@ -262,7 +396,7 @@ if __name__ == "__main__":
     show_image(0)
 
     # Get all the features of the images
-    features = calculate_features(data_loader)
+    features, labels = calculate_features(data_loader, batch_size, pad_batches=compile_model)
 
     print("Extracted features: ", len(features), " features.")
 
@@ -275,6 +409,9 @@ if __name__ == "__main__":
     print("Similarity scores calculated.")
 
     number_of_iterations = 9  # The number of iterations
+    k = 5  # The number of images in each hyperedge
+
+    position_weights = get_position_weights(k)
 
     print("Number of iterations: ", number_of_iterations)
 
@@ -284,18 +421,18 @@ if __name__ == "__main__":
 
         # ---Rank Normalization---
         # Rank normalization of the similarity scores
-        normalized_similarity_scores = rank_normalization(similarity_scores)
+        normalized_ranks = rank_normalization(similarity_scores)
 
         print("Rank normalization completed.")
 
         # ---Hypergraph Construction---
         # Get the Hyperedges
-        hyperedges = get_hypergraph_construction(normalized_similarity_scores)
+        hyperedges = get_hypergraph_construction(normalized_ranks, k)
 
         print("Hypergraph construction completed.")
 
         # Get the Edge Associations
-        edge_associations = create_edge_associations(hyperedges)
+        edge_associations = create_edge_associations(hyperedges, position_weights)
 
         print("Edge associations created.")
 
@@ -322,30 +459,27 @@ if __name__ == "__main__":
 
         print("Affinity matrix calculated.")
 
-        # Convert the affinity matrix to a list
-        affinity_matrix_list = affinity_matrix.tolist()
-
-        for h, row in enumerate(affinity_matrix_list):
-            for j, v in enumerate(row):
-                affinity_matrix_list[h][j] = (j, affinity_matrix_list[h][j])
-
-        similarity_scores = affinity_matrix_list
+        similarity_scores = affinity_matrix
 
         print("Similarity scores updated.")
         print("------Iteration: ", i + 1, " completed.------")
 
     # Retrieve the images
     query_image_index = 0
-    retrieved_images = []
-    for (i, score) in similarity_scores[query_image_index]:
-        if score != 0:
-            retrieved_images.append((i, score))
-    retrieved_images = sorted(retrieved_images, key=lambda x: x[1], reverse=True)
+    # Copy the scores of the query image to host memory
+    scores = similarity_scores[query_image_index].cpu().numpy()
+    retrieved_indices = np.flatnonzero(scores)
+
+    print("Retrieved images: ", len(retrieved_indices))
 
-    print("Retrieved images: ", len(retrieved_images))
+    # Select the top 5 images without sorting all the retrieved images, then sort only those 5
+    top = min(5, len(retrieved_indices))
+    top_indices = retrieved_indices[np.argpartition(-scores[retrieved_indices], top - 1)[:top]]
+    top_indices = np.sort(top_indices)  # argpartition does not keep the index order, which breaks ties below
+    top_indices = top_indices[np.argsort(-scores[top_indices], kind='stable')]
+    retrieved_images = [(j, scores[j]) for j in top_indices]
 
     # Show the first 5 images
-    retrieved_images = retrieved_images[:5]
     for i in range(len(retrieved_images)):
         image_index, score = retrieved_images[i]
         show_image(image_index, True, str(i))
@@ -353,8 +487,8 @@ if __name__ == "__main__":
     print("The top 5 retrieved images saved to the retrieved_images folder.")
 
     # Retrieved images accuracy: the class of the query image is the same as the class of the retrieved images
-    query_image_label = data_loader[query_image_index][1]
+    query_image_label = labels[query_image_index]
 
     # Calculate the accuracy
-    accuracy = calculate_accuracy(retrieved_images, query_image_label)
+    accuracy = calculate_accuracy(retrieved_images, query_image_label, labels)
     print(f"Accuracy: {accuracy}%")